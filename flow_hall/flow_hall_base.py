@@ -0,0 +1,126 @@
+import machine
+import network
+import socket
+import time
+import ubinascii
+import ujson
+import urequests
+
+# *********************************************
+# CONFIG FILES
+# *********************************************
+COMMS_CONFIG_FILE = "comms_config.json"
+
+
+def get_hw_uid():
+    return f"pico_{ubinascii.hexlify(machine.unique_id()).decode()[-6:]}"
+
+
+class FlowHallBase:
+    # Machinery shared by the flow_hall variants. Only one copy of this
+    # bytecode is compiled and loaded, whatever variant ships as main.py;
+    # variants subclass and keep their own __init__, pulse_callback,
+    # post_ticklist and main_loop.
+
+    def __init__(self):
+        self.hw_uid = get_hw_uid()
+        self.load_comms_config()
+        self._addr = None
+        self._host_header = None
+
+    def resolve_base_url(self):
+        # Resolve the base_url host once instead of paying a DNS lookup
+        # (and its radio time) on every POST
+        rest = self.base_url.split("://", 1)[-1]
+        hostport = rest.split("/", 1)[0]
+        if ":" in hostport:
+            host, port = hostport.split(":", 1)
+            port = int(port)
+        else:
+            host, port = hostport, 80
+        self._host_header = hostport
+        self._addr = socket.getaddrinfo(host, port)[0][-1]
+
+    def http_post(self, path, body, content_type="application/json"):
+        # One-shot POST straight to the cached address, bypassing DNS.
+        # Returns the response status code; the address cache is dropped
+        # on failure so the next call re-resolves.
+        if self._addr is None:
+            self.resolve_base_url()
+        s = socket.socket()
+        try:
+            s.connect(self._addr)
+            s.send(
+                (
+                    "POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: %s\r\n"
+                    "Content-Length: %d\r\nConnection: close\r\n\r\n"
+                    % (path, self._host_header, content_type, len(body))
+                ).encode()
+            )
+            s.send(body)
+            status_line = s.readline()
+            while True:
+                line = s.readline()
+                if not line or line == b"\r\n":
+                    break
+            return int(status_line.split(b" ")[1])
+        except OSError:
+            self._addr = None
+            raise
+        finally:
+            s.close()
+
+    def load_comms_config(self):
+        try:
+            with open(COMMS_CONFIG_FILE, "r") as f:
+                comms_config = ujson.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Error loading comms config file: {e}")
+        self.wifi_name = comms_config.get("WifiName")
+        self.wifi_password = comms_config.get("WifiPassword")
+        self.base_url = comms_config.get("BaseUrl")
+        if self.wifi_name is None:
+            raise KeyError("WifiName not found in comms_config.json")
+        if self.wifi_password is None:
+            raise KeyError("WifiPassword not found in comms_config.json")
+        if self.base_url is None:
+            raise KeyError("BaseUrl not found in comms_config.json")
+
+    def connect_to_wifi(self):
+        wlan = network.WLAN(network.STA_IF)
+        wlan.active(True)
+        if not wlan.isconnected():
+            print("Connecting to wifi...")
+            wlan.connect(self.wifi_name, self.wifi_password)
+            while not wlan.isconnected():
+                time.sleep(1)
+        print(f"Connected to wifi {self.wifi_name}")
+
+    def _rebuild_urls(self):
+        # Called once at construction and again only if update_app_config
+        # changes actor_node_name, so no post path rebuilds URL strings
+        self._code_url = self.base_url + "/" + self.actor_node_name + "/code-update"
+
+    def update_code(self):
+        url = self._code_url
+        payload = {
+            "HwUid": self.hw_uid,
+            "ActorNodeName": self.actor_node_name,
+            "TypeName": "new.code",
+            "Version": "000",
+        }
+        json_payload = ujson.dumps(payload)
+        headers = {"Content-Type": "application/json"}
+        try:
+            response = urequests.post(url, data=json_payload, headers=headers)
+            if response.status_code == 200:
+                # A pending code update comes back as a python file, otherwise json
+                try:
+                    ujson.loads(response.content.decode("utf-8"))
+                except (ValueError, UnicodeError):
+                    with open("main_update.py", "wb") as f:
+                        f.write(response.content)
+                    machine.reset()
+            response.close()
+        except Exception as e:
+            print(f"Error updating code: {e}")
@@ -0,0 +1,266 @@
+import gc
+import struct
+
+import micropython
+import ujson
+import urequests
+import utime
+from array import array
+from machine import Pin
+
+from flow_hall_base import FlowHallBase
+
+# *********************************************
+# CONFIG FILES AND DEFAULT PARAMS
+# *********************************************
+APP_CONFIG_FILE = "app_config.json"
+
+DEFAULT_ACTOR_NAME = "pico-flow-hall"
+DEFAULT_FLOW_NODE_NAME = "primary-flow"
+DEFAULT_DEADBAND_MICROSECONDS = 300
+DEFAULT_PUBLISH_TICKLIST_PERIOD_S = 10
+DEFAULT_PUBLISH_EMPTY_TICKLIST_AFTER_S = 60
+
+# *********************************************
+# CONSTANTS
+# *********************************************
+PULSE_PIN = 28
+MAX_TICKS = 2000
+MIN_FREE_HEAP_BYTES = 8192
+# Binary ticklist header: first tick unix time in ms (uint64), tick count (uint16)
+TICKLIST_HEADER_FMT = ">QH"
+TICKLIST_HEADER_LEN = 10
+CODE_UPDATE_PERIOD_S = 60
+
+
+@micropython.viper
+def encode_deltas(src: ptr32, n: int, dst: ptr8, o: int) -> int:
+    # Varint-encode the deltas between n successive uint32 microsecond
+    # timestamps in src, writing into dst starting at offset o. A
+    # non-monotonic timestamp (IRQ raced the buffer swap) is clamped to a
+    # zero delta rather than poisoning the varint loop. Returns the total
+    # number of bytes written to dst.
+    prev: int = 0
+    for i in range(n):
+        v: int = int(src[i]) - prev
+        prev = int(src[i])
+        if v < 0:
+            v = 0
+        while v > 0x7F:
+            dst[o] = (v & 0x7F) | 0x80
+            o += 1
+            v >>= 7
+        dst[o] = v
+        o += 1
+    return o
+
+
+class PicoFlowHall(FlowHallBase):
+    def __init__(self):
+        super().__init__()
+        self.load_app_config()
+        self.pulse_pin = Pin(PULSE_PIN, Pin.IN, Pin.PULL_UP)
+        # Tick storage: microseconds relative to the first tick of the batch
+        self.relative_us_buf = array("I", bytes(4 * MAX_TICKS))
+        self.n_ticks = 0
+        self.first_tick_us = None
+        self.first_tick_ms = None
+        # Outgoing frame: header + worst-case 5 varint bytes per tick
+        self._tx_buf = bytearray(TICKLIST_HEADER_LEN + 5 * MAX_TICKS)
+        self.last_ticks_sent_s = utime.time()
+        self.last_code_update_s = utime.time()
+        self._rebuild_urls()
+
+    def _rebuild_urls(self):
+        super()._rebuild_urls()
+        self._ticklist_path = "/" + self.actor_node_name + "/ticklist"
+        self._params_url = (
+            self.base_url + "/" + self.actor_node_name + "/flow-hall-params"
+        )
+
+    # ---------------------------------
+    # Config
+    # ---------------------------------
+    def load_app_config(self):
+        try:
+            with open(APP_CONFIG_FILE, "r") as f:
+                app_config = ujson.load(f)
+        except (OSError, ValueError):
+            app_config = {}
+        self.actor_node_name = app_config.get("ActorNodeName", DEFAULT_ACTOR_NAME)
+        self.flow_node_name = app_config.get("FlowNodeName", DEFAULT_FLOW_NODE_NAME)
+        self.deadband_microseconds = app_config.get(
+            "DeadbandMicroseconds", DEFAULT_DEADBAND_MICROSECONDS
+        )
+        self.publish_ticklist_period_s = app_config.get(
+            "PublishTicklistPeriodS", DEFAULT_PUBLISH_TICKLIST_PERIOD_S
+        )
+        self.publish_empty_ticklist_after_s = app_config.get(
+            "PublishEmptyTicklistAfterS", DEFAULT_PUBLISH_EMPTY_TICKLIST_AFTER_S
+        )
+        self._saved_config_values = None
+
+    def save_app_config(self):
+        # The schema is fixed, so write the JSON literally instead of
+        # building a dict for ujson.dump, and skip the flash write
+        # entirely when nothing changed since the last save
+        values = (
+            self.actor_node_name,
+            self.flow_node_name,
+            self.deadband_microseconds,
+            self.publish_ticklist_period_s,
+            self.publish_empty_ticklist_after_s,
+        )
+        if values == self._saved_config_values:
+            return
+        with open(APP_CONFIG_FILE, "w") as f:
+            f.write('{"ActorNodeName":"')
+            f.write(self.actor_node_name)
+            f.write('","FlowNodeName":"')
+            f.write(self.flow_node_name)
+            f.write('","DeadbandMicroseconds":')
+            f.write(str(self.deadband_microseconds))
+            f.write(',"PublishTicklistPeriodS":')
+            f.write(str(self.publish_ticklist_period_s))
+            f.write(',"PublishEmptyTicklistAfterS":')
+            f.write(str(self.publish_empty_ticklist_after_s))
+            f.write("}")
+        self._saved_config_values = values
+
+    def update_app_config(self):
+        url = self._params_url
+        payload = {
+            "HwUid": self.hw_uid,
+            "ActorNodeName": self.actor_node_name,
+            "FlowNodeName": self.flow_node_name,
+            "DeadbandMicroseconds": self.deadband_microseconds,
+            "PublishTicklistPeriodS": self.publish_ticklist_period_s,
+            "PublishEmptyTicklistAfterS": self.publish_empty_ticklist_after_s,
+            "TypeName": "flow.hall.params",
+            "Version": "000",
+        }
+        json_payload = ujson.dumps(payload)
+        headers = {"Content-Type": "application/json"}
+        try:
+            response = urequests.post(url, data=json_payload, headers=headers)
+            if response.status_code == 200:
+                updated_config = response.json()
+                old_actor_node_name = self.actor_node_name
+                self.actor_node_name = updated_config.get(
+                    "ActorNodeName", self.actor_node_name
+                )
+                self.flow_node_name = updated_config.get(
+                    "FlowNodeName", self.flow_node_name
+                )
+                self.deadband_microseconds = updated_config.get(
+                    "DeadbandMicroseconds", self.deadband_microseconds
+                )
+                self.publish_ticklist_period_s = updated_config.get(
+                    "PublishTicklistPeriodS", self.publish_ticklist_period_s
+                )
+                self.publish_empty_ticklist_after_s = updated_config.get(
+                    "PublishEmptyTicklistAfterS", self.publish_empty_ticklist_after_s
+                )
+                self.save_app_config()
+                if self.actor_node_name != old_actor_node_name:
+                    self._rebuild_urls()
+            response.close()
+        except Exception as e:
+            print(f"Error updating app config: {e}")
+
+    # ---------------------------------
+    # Ticks
+    # ---------------------------------
+    def pulse_callback(self, pin):
+        now_us = utime.ticks_us()
+        if self.n_ticks == 0:
+            self.first_tick_us = now_us
+            self.first_tick_ms = utime.time_ns() // 1_000_000
+            self.relative_us_buf[0] = 0
+            self.n_ticks = 1
+            return
+        relative_us = utime.ticks_diff(now_us, self.first_tick_us)
+        if relative_us - self.relative_us_buf[self.n_ticks - 1] < self.deadband_microseconds:
+            return
+        if self.n_ticks < MAX_TICKS:
+            self.relative_us_buf[self.n_ticks] = relative_us
+            self.n_ticks += 1
+
+    def post_ticklist(self):
+        first_ms = self.first_tick_ms
+        if first_ms is None:
+            # Empty ticklist: report "no flow" stamped at the time of posting
+            first_ms = utime.time_ns() // 1_000_000
+        n = self.n_ticks
+        struct.pack_into(TICKLIST_HEADER_FMT, self._tx_buf, 0, first_ms, n)
+        # Hot loop: delta-encode up to MAX_TICKS uint32 timestamps natively
+        end = encode_deltas(self.relative_us_buf, n, self._tx_buf, TICKLIST_HEADER_LEN)
+        try:
+            self.http_post(
+                self._ticklist_path,
+                memoryview(self._tx_buf)[:end],
+                content_type="application/octet-stream",
+            )
+        except Exception as e:
+            print(f"Error posting ticklist: {e}")
+        self.n_ticks = 0
+        self.first_tick_us = None
+        self.first_tick_ms = None
+
+    # ---------------------------------
+    # Main loop
+    # ---------------------------------
+    def main_loop(self):
+        while True:
+            now_s = utime.time()
+            if self.n_ticks > 0 and (
+                now_s - self.last_ticks_sent_s > self.publish_ticklist_period_s
+                or self.n_ticks >= MAX_TICKS
+            ):
+                self.pulse_pin.irq(handler=None)
+                self.post_ticklist()
+                self.pulse_pin.irq(
+                    trigger=Pin.IRQ_FALLING, handler=self.pulse_callback
+                )
+                self.last_ticks_sent_s = now_s
+            elif (
+                self.n_ticks == 0
+                and now_s - self.last_ticks_sent_s > self.publish_empty_ticklist_after_s
+            ):
+                # Detach the IRQ here too: a pulse interleaving the
+                # first_tick resets would leave n_ticks == 1 with
+                # first_tick_us None and every later callback raising
+                self.pulse_pin.irq(handler=None)
+                self.post_ticklist()
+                self.pulse_pin.irq(
+                    trigger=Pin.IRQ_FALLING, handler=self.pulse_callback
+                )
+                self.last_ticks_sent_s = now_s
+            else:
+                # Idle: nothing pending to publish, so collect now rather
+                # than letting the GC fire mid-IRQ and cost ticks
+                gc.collect()
+            if gc.mem_free() < MIN_FREE_HEAP_BYTES:
+                gc.collect()
+            if now_s - self.last_code_update_s > CODE_UPDATE_PERIOD_S:
+                self.update_code()
+                self.last_code_update_s = now_s
+            utime.sleep_ms(100)
+
+    def start(self):
+        self.connect_to_wifi()
+        self.resolve_base_url()
+        self.update_app_config()
+        self.update_code()
+        # Automatic collection can fire during pulse_callback and inflate
+        # IRQ latency; from here on GC only runs from the main loop
+        gc.collect()
+        gc.disable()
+        self.pulse_pin.irq(trigger=Pin.IRQ_FALLING, handler=self.pulse_callback)
+        print("Started tick collection")
+        self.main_loop()
+
+
+if __name__ == "__main__":
+    p = PicoFlowHall()
+    p.start()
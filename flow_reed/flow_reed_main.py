@@ -0,0 +1,742 @@
+import gc
+import struct
+
+import machine
+import micropython
+import network
+import socket
+import ubinascii
+import ujson
+import uos
+import utime
+from array import array
+from machine import Pin, Timer
+from micropython import const
+
+import provisioner
+
+# *********************************************
+# CONFIG FILES AND DEFAULT PARAMS
+# *********************************************
+COMMS_CONFIG_FILE = "comms_config.json"
+APP_CONFIG_FILE = "app_config.json"
+
+DEFAULT_ACTOR_NAME = "pico-flow-reed"
+DEFAULT_FLOW_NODE_NAME = "primary-flow"
+DEFAULT_GALLONS_PER_TICK_TIMES_10000 = const(748)
+DEFAULT_DEADBAND_MILLISECONDS = const(300)
+DEFAULT_ALPHA_TIMES_100 = const(10)
+DEFAULT_ASYNC_DELTA_GPM_TIMES_100 = const(10)
+DEFAULT_NO_FLOW_MILLISECONDS = const(30_000)
+DEFAULT_MAX_BATCH_MS = const(10_000)
+
+# *********************************************
+# CONSTANTS
+# *********************************************
+PULSE_PIN = const(28)
+# 250 deltas is ~1 KB on the wire; bigger batches amortize the HTTP
+# round trip and the age deadline still bounds latency at low flow
+POST_LIST_LENGTH = const(250)
+RING_SIZE = const(128)  # power of two so the ISR can mask instead of modulo
+# Ring indices wrap at twice the ring size (empty vs full stays
+# distinguishable) so they remain small ints forever: an unbounded
+# counter would eventually need a big-int increment, which allocates -
+# fatal inside a hard IRQ with the heap locked
+RING_WRAP = const(2 * RING_SIZE - 1)
+MIN_FREE_HEAP_BYTES = const(8192)
+TIME_WEIGHTING_MS = const(800)
+# Binary batch frame: first tick unix time in ns (uint64), gpm times 100
+# (uint16), heartbeat counter (uint8), tick count (uint16), then one
+# uint16 delta-ms per tick
+BATCH_HEADER_FMT = ">QHBH"
+BATCH_HEADER_LEN = const(13)
+
+# Heartbeat body is patched in place: byte 10 is the hex digit
+HB_BUF_HEX_OFFSET = const(10)
+HEX_DIGITS = b"0123456789abcdef"
+HB_PERIOD_MS = const(3000)
+CODE_UPDATE_PERIOD_S = const(60)
+WIFI_CONNECT_TIMEOUT_MS = const(30_000)
+WIFI_CHECK_PERIOD_S = const(5)
+
+PENDING_GPM = const(1)
+PENDING_HB = const(2)
+
+
+def get_hw_uid():
+    return f"pico_{ubinascii.hexlify(machine.unique_id()).decode()[-6:]}"
+
+
+def _find_value(body, key):
+    # Returns the offset just past '"key":' (and any spaces), or -1
+    i = body.find(b'"' + key + b'"')
+    if i < 0:
+        return -1
+    i = body.find(b":", i)
+    if i < 0:
+        return -1
+    i += 1
+    while body[i : i + 1] in (b" ", b"\t"):
+        i += 1
+    return i
+
+
+def _json_int(body, key, default):
+    i = _find_value(body, key)
+    if i < 0:
+        return default
+    j = i
+    if body[j : j + 1] == b"-":
+        j += 1
+    while body[j : j + 1].isdigit():
+        j += 1
+    if j == i:
+        return default
+    return int(body[i:j])
+
+
+def _json_str(body, key, default):
+    i = _find_value(body, key)
+    if i < 0 or body[i : i + 1] != b'"':
+        return default
+    j = body.find(b'"', i + 1)
+    if j < 0:
+        return default
+    return body[i + 1 : j].decode()
+
+
+class PicoFlowReed:
+    # Concurrency contract: timer/pin callbacks run in ISR context and
+    # only write into preallocated state (the edge ring, the hb counter,
+    # the pending bitmask). The main loop is the sole consumer and the
+    # only code that touches the socket, so no locking is needed.
+
+    def __init__(self):
+        # Timer and IRQ callbacks cannot allocate, so give MicroPython a
+        # static buffer to report exceptions raised inside them
+        micropython.alloc_emergency_exception_buf(100)
+        self.hw_uid = get_hw_uid()
+        self.load_comms_config()
+        self.load_app_config()
+        self.pulse_pin = Pin(PULSE_PIN, Pin.IN, Pin.PULL_UP)
+        # Edge timestamps land in this ring from the pin IRQ; the main
+        # loop drains it, so no edge is lost while a post is in flight
+        self._ring = array("i", bytes(4 * RING_SIZE))
+        self._ri = 0
+        self._wi = 0
+        # Tick deltas land by index in a preallocated uint16 array so the
+        # hot path never grows a Python list (no heap churn, no GC pauses)
+        self._ticks = array("H", bytes(2 * POST_LIST_LENGTH))
+        self._ntick = 0
+        self.first_tick_ms = None
+        self.first_tick_ns = None
+        self.last_tick_ms = None
+        # EMA state in Q16 fixed point: the RP2040 has no FPU, so soft
+        # floats cost cycles and a heap box per result. Integers stay
+        # small-int and allocation-free.
+        self._exp_gpm_q16 = 0
+        self._prev_gpm_q16 = None
+        self.hb = 0
+        # Pending-telemetry bitmask (PENDING_GPM | PENDING_HB): the main
+        # loop is the only poster, and a batch post carries whatever is
+        # pending so gpm/hb don't cost their own HTTP transactions.
+        # One int means the idle loop tests one truthy word, not a flag
+        # per telemetry type.
+        self._pending = 0
+        self._frame = bytearray(BATCH_HEADER_LEN + 2 * POST_LIST_LENGTH)
+        # Heartbeat body lives in a prebuilt buffer; posting just patches
+        # one byte instead of formatting a fresh payload
+        self._hb_buf = bytearray(b'{"MyHex":"0","TypeName":"hb","Version":"000"}')
+        self.heartbeat_timer = Timer(-1)
+        self.last_code_update_s = utime.time()
+        self.wlan = None
+        self._wifi_reconnecting = False
+        self._last_wifi_check_s = utime.time()
+        # Exponential backoff gate on the post path: a flapping network
+        # fails fast once, then waits instead of burning CPU on doomed
+        # connect() calls every loop iteration
+        self._backoff_s = 0
+        self._next_try_s = 0
+        # Persistent keep-alive HTTP session to base_url
+        self.sock = None
+        self._host = None
+        self._port = None
+        self._host_header = None
+
+    # ---------------------------------
+    # Config
+    # ---------------------------------
+    def load_comms_config(self):
+        try:
+            with open(COMMS_CONFIG_FILE, "r") as f:
+                comms_config = ujson.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError("Error loading comms config file: " + str(e))
+        self.wifi_name = comms_config.get("WifiName")
+        self.wifi_password = comms_config.get("WifiPassword")
+        self.base_url = comms_config.get("BaseUrl")
+        if self.wifi_name is None:
+            raise KeyError("WifiName not found in comms_config.json")
+        if self.wifi_password is None:
+            raise KeyError("WifiPassword not found in comms_config.json")
+        if self.base_url is None:
+            raise KeyError("BaseUrl not found in comms_config.json")
+
+    def load_app_config(self):
+        # A provisioned board carries its names in the fixed 32-byte
+        # struct record; reading that beats parsing them out of JSON and
+        # survives an app_config wipe
+        names = provisioner.load_names()
+        if names is not None:
+            default_actor_name, default_flow_name = names
+        else:
+            default_actor_name = DEFAULT_ACTOR_NAME
+            default_flow_name = DEFAULT_FLOW_NODE_NAME
+        try:
+            with open(APP_CONFIG_FILE, "r") as f:
+                app_config = ujson.load(f)
+        except (OSError, ValueError):
+            app_config = {}
+        self.actor_node_name = app_config.get("ActorNodeName", default_actor_name)
+        self.flow_node_name = app_config.get("FlowNodeName", default_flow_name)
+        self.gallons_per_tick = (
+            app_config.get(
+                "GallonsPerTickTimes10000", DEFAULT_GALLONS_PER_TICK_TIMES_10000
+            )
+            / 10_000
+        )
+        self.deadband_milliseconds = app_config.get(
+            "DeadbandMilliseconds", DEFAULT_DEADBAND_MILLISECONDS
+        )
+        self.alpha = app_config.get("AlphaTimes100", DEFAULT_ALPHA_TIMES_100) / 100
+        self.async_delta_gpm = (
+            app_config.get("AsyncDeltaGpmTimes100", DEFAULT_ASYNC_DELTA_GPM_TIMES_100)
+            / 100
+        )
+        self.no_flow_milliseconds = app_config.get(
+            "NoFlowMilliseconds", DEFAULT_NO_FLOW_MILLISECONDS
+        )
+        self.max_batch_ms = app_config.get("MaxBatchMs", DEFAULT_MAX_BATCH_MS)
+        self._saved_config_values = None
+        self._rebuild_payload_templates()
+        self._rebuild_urls()
+
+    def _rebuild_urls(self):
+        # Endpoint paths are pure functions of actor_node_name; build them
+        # once here instead of f-string interpolating per post
+        prefix = "/" + self.actor_node_name
+        self._gpm_path = (prefix + "/gpm").encode()
+        self._hb_path = (prefix + "/hb").encode()
+        self._batch_path = (prefix + "/batch").encode()
+        self._params_path = (prefix + "/flow-reed-params").encode()
+        self._code_path = (prefix + "/code-update").encode()
+
+    def _rebuild_payload_templates(self):
+        # Everything but the value is constant, so bake the node name in
+        # once; post_gpm is then a single %-format, no dict and no ujson
+        self._gpm_tmpl = (
+            b'{"AboutNodeName":"'
+            + self.flow_node_name.encode()
+            + b'","ValueTimes100":%d,"TypeName":"gpm","Version":"000"}'
+        )
+        # gallons_per_tick * 60 * (1000 / delta_ms) folded into one Q16
+        # constant so each tick costs a single integer divide
+        self._gpm_k_q16 = int(self.gallons_per_tick * 60000 * 65536)
+        self._alpha_q16 = int(self.alpha * 65536)
+        self._async_delta_gpm_q16 = int(self.async_delta_gpm * 65536)
+
+    def save_app_config(self):
+        # Skip the flash write (slow, and a wear cycle) when the server
+        # echoed back exactly what we already have
+        values = (
+            self.actor_node_name,
+            self.flow_node_name,
+            int(self.gallons_per_tick * 10_000),
+            self.deadband_milliseconds,
+            int(self.alpha * 100),
+            int(self.async_delta_gpm * 100),
+            self.no_flow_milliseconds,
+            self.max_batch_ms,
+        )
+        if values == self._saved_config_values:
+            return
+        config = {
+            "ActorNodeName": self.actor_node_name,
+            "FlowNodeName": self.flow_node_name,
+            "GallonsPerTickTimes10000": int(self.gallons_per_tick * 10_000),
+            "DeadbandMilliseconds": self.deadband_milliseconds,
+            "AlphaTimes100": int(self.alpha * 100),
+            "AsyncDeltaGpmTimes100": int(self.async_delta_gpm * 100),
+            "NoFlowMilliseconds": self.no_flow_milliseconds,
+            "MaxBatchMs": self.max_batch_ms,
+        }
+        # Write-then-rename so a power cut mid-write can never leave a
+        # truncated config behind
+        with open(APP_CONFIG_FILE + ".tmp", "w") as f:
+            ujson.dump(config, f)
+        uos.rename(APP_CONFIG_FILE + ".tmp", APP_CONFIG_FILE)
+        self._saved_config_values = values
+
+    def update_app_config(self):
+        payload = {
+            "HwUid": self.hw_uid,
+            "ActorNodeName": self.actor_node_name,
+            "FlowNodeName": self.flow_node_name,
+            "GallonsPerTickTimes10000": int(self.gallons_per_tick * 10_000),
+            "DeadbandMilliseconds": self.deadband_milliseconds,
+            "AlphaTimes100": int(self.alpha * 100),
+            "AsyncDeltaGpmTimes100": int(self.async_delta_gpm * 100),
+            "NoFlowMilliseconds": self.no_flow_milliseconds,
+            "MaxBatchMs": self.max_batch_ms,
+            "TypeName": "flow.reed.params",
+            "Version": "000",
+        }
+        json_payload = ujson.dumps(payload)
+        try:
+            status, body = self._post(self._params_path, json_payload)
+            if status == 200 and body:
+                # The schema is fixed, so scan out just the fields we use
+                # instead of building a full dict with ujson.loads
+                old_actor_node_name = self.actor_node_name
+                self.actor_node_name = _json_str(
+                    body, b"ActorNodeName", self.actor_node_name
+                )
+                self.flow_node_name = _json_str(
+                    body, b"FlowNodeName", self.flow_node_name
+                )
+                self.gallons_per_tick = (
+                    _json_int(
+                        body,
+                        b"GallonsPerTickTimes10000",
+                        int(self.gallons_per_tick * 10_000),
+                    )
+                    / 10_000
+                )
+                self.deadband_milliseconds = _json_int(
+                    body, b"DeadbandMilliseconds", self.deadband_milliseconds
+                )
+                self.alpha = (
+                    _json_int(body, b"AlphaTimes100", int(self.alpha * 100)) / 100
+                )
+                self.async_delta_gpm = (
+                    _json_int(
+                        body, b"AsyncDeltaGpmTimes100", int(self.async_delta_gpm * 100)
+                    )
+                    / 100
+                )
+                self.no_flow_milliseconds = _json_int(
+                    body, b"NoFlowMilliseconds", self.no_flow_milliseconds
+                )
+                self.max_batch_ms = _json_int(body, b"MaxBatchMs", self.max_batch_ms)
+                self._rebuild_payload_templates()
+                if self.actor_node_name != old_actor_node_name:
+                    self._rebuild_urls()
+                self.save_app_config()
+        except Exception as e:
+            print("Error updating app config:", e)
+
+    def update_code(self):
+        payload = {
+            "HwUid": self.hw_uid,
+            "ActorNodeName": self.actor_node_name,
+            "TypeName": "new.code",
+            "Version": "000",
+        }
+        json_payload = ujson.dumps(payload).encode()
+        try:
+            if self.sock is None:
+                self._connect_session()
+            status, remaining, keep_alive = self._send_request(
+                self._code_path, json_payload, b"application/json"
+            )
+            # A pending code update comes back as a python file, otherwise
+            # json; the first non-whitespace byte is enough to tell which
+            first = b""
+            while remaining:
+                first = self.sock.read(1)
+                if not first:
+                    remaining = 0
+                    break
+                remaining -= 1
+                if first not in (b" ", b"\t", b"\r", b"\n"):
+                    break
+            if status == 200 and first and first not in (b"{", b"["):
+                # Stream to flash in 512-byte chunks; the file never has
+                # to fit in one contiguous heap block
+                with open("main_update.py", "wb") as f:
+                    f.write(first)
+                    while remaining > 0:
+                        chunk = self.sock.read(min(512, remaining))
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                machine.reset()
+            while remaining > 0:
+                chunk = self.sock.read(min(512, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+            if not keep_alive:
+                self.sock.close()
+                self.sock = None
+        except OSError as e:
+            print("Error updating code:", e)
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+        gc.collect()
+
+    # ---------------------------------
+    # Wifi and HTTP session
+    # ---------------------------------
+    def connect_to_wifi(self):
+        wlan = self.wlan = network.WLAN(network.STA_IF)
+        wlan.active(True)
+        # Turn off the CYW43 power-save default: it adds hundreds of ms
+        # of latency to every post for milliwatts of savings
+        wlan.config(pm=0xA11140)
+        if not wlan.isconnected():
+            print("Connecting to wifi...")
+            wlan.connect(self.wifi_name, self.wifi_password)
+            t0 = utime.ticks_ms()
+            while not wlan.isconnected():
+                if utime.ticks_diff(utime.ticks_ms(), t0) > WIFI_CONNECT_TIMEOUT_MS:
+                    raise RuntimeError("Timed out connecting to wifi")
+                utime.sleep_ms(100)
+        print("Connected to wifi", self.wifi_name)
+
+    def check_wifi(self):
+        # Non-blocking link watchdog: one status poll, and if the router
+        # went away, kick off a reconnect and return. Ticks keep landing
+        # in the ring by IRQ during the outage and the post backoff
+        # already keeps the loop from burning time on a dead socket.
+        if self.wlan.isconnected():
+            self._wifi_reconnecting = False
+            return
+        if (
+            self._wifi_reconnecting
+            and self.wlan.status() != network.STAT_CONNECTING
+        ):
+            # The join attempt ended without a link (AP still down, auth
+            # rejected): the driver does not retry on its own, so clear
+            # the latch and issue a fresh connect below
+            self._wifi_reconnecting = False
+        if not self._wifi_reconnecting:
+            print("Wifi down - reconnecting...")
+            try:
+                self.wlan.connect(self.wifi_name, self.wifi_password)
+                self._wifi_reconnecting = True
+            except OSError as e:
+                print("Error starting wifi reconnect:", e)
+
+    def _connect_session(self):
+        if self._host is None:
+            rest = self.base_url.split("://", 1)[-1]
+            hostport = rest.split("/", 1)[0]
+            if ":" in hostport:
+                self._host, port = hostport.split(":", 1)
+                self._port = int(port)
+            else:
+                self._host, self._port = hostport, 80
+            self._host_header = hostport
+            # Request preamble with the host baked in: each post is then
+            # a single C-level %-format of path, type and length
+            self._req_fmt = (
+                b"POST %s HTTP/1.1\r\nHost: "
+                + hostport.encode()
+                + b"\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                + b"Connection: keep-alive\r\n\r\n"
+            )
+        addr = socket.getaddrinfo(self._host, self._port)[0][-1]
+        self.sock = socket.socket()
+        self.sock.connect(addr)
+
+    def _send_request(self, path, body, content_type):
+        # Send one POST on the session socket and parse the response
+        # status line and headers; the body is left unread on the socket.
+        # Returns (status_code, content_length, keep_alive).
+        self.sock.send(self._req_fmt % (path, content_type, len(body)))
+        self.sock.send(body)
+        status_line = self.sock.readline()
+        status = int(status_line.split(b" ")[1])
+        content_length = 0
+        keep_alive = True
+        while True:
+            line = self.sock.readline()
+            if not line or line == b"\r\n":
+                break
+            lower = line.lower()
+            if lower.startswith(b"content-length:"):
+                content_length = int(line.split(b":", 1)[1])
+            elif lower.startswith(b"connection:") and b"close" in lower:
+                keep_alive = False
+        return status, content_length, keep_alive
+
+    def _post(self, path, body, content_type=b"application/json"):
+        # POST over the persistent keep-alive session, reconnecting once
+        # on a stale socket. Returns (status_code, body_bytes).
+        if isinstance(body, str):
+            body = body.encode()
+        for attempt in range(2):
+            if self.sock is None:
+                self._connect_session()
+            try:
+                status, content_length, keep_alive = self._send_request(
+                    path, body, content_type
+                )
+                response_body = b""
+                while len(response_body) < content_length:
+                    chunk = self.sock.read(content_length - len(response_body))
+                    if not chunk:
+                        break
+                    response_body += chunk
+                if not keep_alive:
+                    self.sock.close()
+                    self.sock = None
+                return status, response_body
+            except OSError:
+                self.sock.close()
+                self.sock = None
+                if attempt == 1:
+                    raise
+        return None, b""
+
+    # ---------------------------------
+    # Posting
+    # ---------------------------------
+    def _note_post_success(self):
+        self._backoff_s = 0
+        self._next_try_s = 0
+
+    def _note_post_failure(self):
+        self._backoff_s = min(30, max(1, self._backoff_s * 2))
+        self._next_try_s = utime.time() + self._backoff_s
+
+    def _try_post(self, label, path, body, content_type=b"application/json"):
+        # Shared post wrapper: one copy of the error handling and backoff
+        # bookkeeping instead of a clone per endpoint
+        try:
+            self._post(path, body, content_type)
+            self._note_post_success()
+            return True
+        except Exception as e:
+            print("Error posting", label, "-", e)
+            self._note_post_failure()
+            return False
+
+    @property
+    def exp_gpm(self):
+        # Float view of the Q16 EMA, for the cold paths and the REPL
+        return self._exp_gpm_q16 / 65536
+
+    def post_gpm(self):
+        body = self._gpm_tmpl % ((self._exp_gpm_q16 * 100) >> 16)
+        if self._try_post("gpm", self._gpm_path, body):
+            self._pending &= ~PENDING_GPM
+            self._prev_gpm_q16 = self._exp_gpm_q16
+
+    def post_ticklist_reed(self):
+        # One batch request carries the ticklist plus whatever gpm/hb
+        # telemetry is pending, packed as a binary frame into the
+        # preallocated buffer: uint16 tick deltas are ~4x smaller on the
+        # wire than their JSON text and skip ujson.dumps over a long list
+        n = self._ntick
+        struct.pack_into(
+            BATCH_HEADER_FMT,
+            self._frame,
+            0,
+            self.first_tick_ns or 0,
+            ((self._exp_gpm_q16 * 100) >> 16) & 0xFFFF,
+            self.hb,
+            n,
+        )
+        offset = BATCH_HEADER_LEN
+        for i in range(n):
+            struct.pack_into(">H", self._frame, offset, self._ticks[i])
+            offset += 2
+        if self._try_post(
+            "ticklist",
+            self._batch_path,
+            memoryview(self._frame)[:offset],
+            content_type=b"application/octet-stream",
+        ):
+            self._pending = 0
+            self._prev_gpm_q16 = self._exp_gpm_q16
+        self._ntick = 0
+        self.first_tick_ms = None
+        self.first_tick_ns = None
+
+    def post_hb(self):
+        self._hb_buf[HB_BUF_HEX_OFFSET] = HEX_DIGITS[self.hb]
+        if self._try_post("hb", self._hb_path, self._hb_buf):
+            self._pending &= ~PENDING_HB
+
+    def publish_heartbeat(self, timer):
+        # Timer callback: just mark the heartbeat pending; the main loop
+        # posts it (or folds it into the next batch)
+        self.hb = (self.hb + 1) % 16
+        self._pending |= PENDING_HB
+
+    # ---------------------------------
+    # GPM
+    # ---------------------------------
+    def update_gpm(self, delta_ms):
+        if delta_ms > self.no_flow_milliseconds:
+            self._exp_gpm_q16 = 0
+        else:
+            gpm_q16 = self._gpm_k_q16 // delta_ms
+            exp_q16 = self._exp_gpm_q16
+            if exp_q16 == 0:
+                self._exp_gpm_q16 = gpm_q16
+            else:
+                tw_alpha_q16 = (delta_ms * self._alpha_q16) // TIME_WEIGHTING_MS
+                if tw_alpha_q16 > 65536:
+                    tw_alpha_q16 = 65536
+                self._exp_gpm_q16 = (
+                    tw_alpha_q16 * gpm_q16 + (65536 - tw_alpha_q16) * exp_q16
+                ) >> 16
+        prev_q16 = self._prev_gpm_q16
+        if (
+            prev_q16 is None
+            or abs(self._exp_gpm_q16 - prev_q16) > self._async_delta_gpm_q16
+        ):
+            self._pending |= PENDING_GPM
+
+    def _mark_no_flow(self):
+        # Direct zero path for the main loop: skips update_gpm's delta
+        # handling entirely when we already know flow has stopped
+        self._exp_gpm_q16 = 0
+        prev_q16 = self._prev_gpm_q16
+        if prev_q16 is None or prev_q16 > self._async_delta_gpm_q16:
+            self._pending |= PENDING_GPM
+
+    # ---------------------------------
+    # Main loop
+    # ---------------------------------
+    @micropython.native
+    def _isr(self, pin):
+        # Falling-edge IRQ: stamp the edge and go. No allocation here.
+        wi = self._wi
+        self._ring[wi & (RING_SIZE - 1)] = utime.ticks_ms()
+        self._wi = (wi + 1) & RING_WRAP
+
+    def main_loop(self):
+        # Bind the hot names once: every self.attr inside the loop is a
+        # dict lookup in MicroPython, a local is a LOAD_FAST
+        ring = self._ring
+        ticks = self._ticks
+        ticks_ms = utime.ticks_ms
+        time_ns = utime.time_ns
+        tdiff = utime.ticks_diff
+        time_s = utime.time
+        idle = machine.idle
+        sleep_ms = utime.sleep_ms
+        mask = RING_SIZE - 1
+        wrap = RING_WRAP
+        deadband = self.deadband_milliseconds
+        no_flow_ms = self.no_flow_milliseconds
+        max_batch_ms = self.max_batch_ms
+        update_gpm = self.update_gpm
+        mark_no_flow = self._mark_no_flow
+        while True:
+            # Drain edges captured by the IRQ, applying the deadband here
+            # rather than in the ISR
+            ri = self._ri
+            while ri != self._wi:
+                tick_ms = ring[ri & mask]
+                ri = (ri + 1) & wrap
+                last_tick_ms = self.last_tick_ms
+                if (
+                    last_tick_ms is not None
+                    and tdiff(tick_ms, last_tick_ms) < deadband
+                ):
+                    continue
+                if self.first_tick_ms is None:
+                    self.first_tick_ms = tick_ms
+                    self.first_tick_ns = time_ns()
+                    ticks[0] = 0
+                    self._ntick = 1
+                else:
+                    delta_ms = tdiff(tick_ms, last_tick_ms)
+                    update_gpm(delta_ms)
+                    # The batch can hit capacity mid-drain (a slow post or
+                    # the failure backoff holds off the flush); drop the
+                    # overflow tick rather than indexing past the array
+                    if self._ntick < POST_LIST_LENGTH:
+                        if delta_ms > 0xFFFF:
+                            delta_ms = 0xFFFF
+                        ticks[self._ntick] = delta_ms
+                        self._ntick += 1
+                self.last_tick_ms = tick_ms
+            self._ri = ri
+            current_time_ms = ticks_ms()
+            now_s = time_s()
+            if now_s >= self._next_try_s:
+                # Flush on a full batch, or on age so low flow rates
+                # still report with bounded latency
+                if self._ntick >= POST_LIST_LENGTH or (
+                    self._ntick
+                    and tdiff(current_time_ms, self.first_tick_ms) > max_batch_ms
+                ):
+                    self.post_ticklist_reed()
+                elif self._pending:
+                    if self._pending & PENDING_GPM:
+                        self.post_gpm()
+                    else:
+                        self.post_hb()
+            if (
+                self.last_tick_ms is not None
+                and tdiff(current_time_ms, self.last_tick_ms) > no_flow_ms
+            ):
+                mark_no_flow()
+            if now_s - self._last_wifi_check_s >= WIFI_CHECK_PERIOD_S:
+                self._last_wifi_check_s = now_s
+                self.check_wifi()
+            if now_s - self.last_code_update_s > CODE_UPDATE_PERIOD_S:
+                self.update_code()
+                self.last_code_update_s = utime.time()
+            # Edges arrive by hard IRQ either way, so when the meter has
+            # been quiet we can sleep longer between ring drains instead
+            # of waking on every interrupt; any backlog is bounded by the
+            # ring and well inside the batch deadlines
+            last_tick_ms = self.last_tick_ms
+            if last_tick_ms is None:
+                quiet_ms = no_flow_ms
+            else:
+                quiet_ms = tdiff(current_time_ms, last_tick_ms)
+            if quiet_ms > 5000:
+                # Quiet meter is the cheapest time to pay for a GC pause
+                if gc.mem_free() < MIN_FREE_HEAP_BYTES:
+                    gc.collect()
+                sleep_ms(20)
+            elif quiet_ms > 1000:
+                sleep_ms(5)
+            else:
+                idle()
+
+    def start_heartbeat_timer(self):
+        self.heartbeat_timer.init(
+            period=HB_PERIOD_MS, mode=Timer.PERIODIC, callback=self.publish_heartbeat
+        )
+
+    def start(self):
+        self.connect_to_wifi()
+        self.update_app_config()
+        self.update_code()
+        # Small amortized collections instead of a full stop-the-world
+        # collect after every post
+        gc.collect()
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+        self.start_heartbeat_timer()
+        # hard=True runs the ISR at interrupt priority instead of via the
+        # soft-IRQ scheduler, so an edge is stamped even mid-GC; the
+        # handler allocates nothing, which is what hard ISRs require
+        self.pulse_pin.irq(trigger=Pin.IRQ_FALLING, handler=self._isr, hard=True)
+        print("Started flow metering")
+        self.main_loop()
+
+
+if __name__ == "__main__":
+    p = PicoFlowReed()
+    p.start()
@@ -0,0 +1,42 @@
+import struct
+
+# *********************************************
+# PROVISIONING RECORD
+# *********************************************
+# Fixed 32-byte record written once when the board is flashed: two
+# zero-padded 16-byte name strings. Reading it at boot is a single
+# f.read(32) + struct.unpack, with no JSON parser involved.
+PROVISION_FILE = "provision.bin"
+PROVISION_FMT = "16s16s"
+PROVISION_LEN = 32
+MAX_NAME_LEN = 16
+
+
+def set_name(actor_node_name, flow_node_name):
+    actor = actor_node_name.encode()
+    flow = flow_node_name.encode()
+    if len(actor) > MAX_NAME_LEN:
+        raise ValueError(f"ActorNodeName longer than {MAX_NAME_LEN} bytes")
+    if len(flow) > MAX_NAME_LEN:
+        raise ValueError(f"FlowNodeName longer than {MAX_NAME_LEN} bytes")
+    with open(PROVISION_FILE, "wb") as f:
+        f.write(struct.pack(PROVISION_FMT, actor, flow))
+
+
+def load_names():
+    # Returns (actor_node_name, flow_node_name), or None if the board
+    # has not been provisioned
+    try:
+        with open(PROVISION_FILE, "rb") as f:
+            record = f.read(PROVISION_LEN)
+    except OSError:
+        return None
+    if len(record) != PROVISION_LEN:
+        return None
+    actor, flow = struct.unpack(PROVISION_FMT, record)
+    return actor.rstrip(b"\x00").decode(), flow.rstrip(b"\x00").decode()
+
+
+if __name__ == "__main__":
+    set_name(input("ActorNodeName: ").strip(), input("FlowNodeName: ").strip())
+    print(f"Wrote {PROVISION_FILE}: {load_names()}")
@@ -0,0 +1,577 @@
+import gc
+import machine
+import micropython
+import network
+import socket
+import ubinascii
+import ujson
+import utime
+from array import array
+from machine import Pin, Timer
+
+# *********************************************
+# CONFIG FILES AND DEFAULT PARAMS
+# *********************************************
+COMMS_CONFIG_FILE = "comms_config.json"
+APP_CONFIG_FILE = "app_config.json"
+
+DEFAULT_ACTOR_NAME = "pico-flow-slow"
+DEFAULT_FLOW_NODE_NAMES = ["primary-flow", "dist-flow", "store-flow"]
+DEFAULT_GALLONS_PER_TICK_TIMES_10000 = 748
+DEFAULT_DEADBAND_MILLISECONDS = 300
+DEFAULT_ALPHA_TIMES_100 = 10
+DEFAULT_ASYNC_DELTA_GPM_TIMES_100 = 10
+DEFAULT_NO_FLOW_MILLISECONDS = 30_000
+
+# Scalar params as one table: (config key, default, attribute, transform).
+# One loop in load_app_config replaces a block of get/assign pairs and
+# keeps key, default and attribute in a single place.
+SCALAR_PARAMS = (
+    ("ActorNodeName", DEFAULT_ACTOR_NAME, "actor_node_name", None),
+    (
+        "DeadbandMilliseconds",
+        DEFAULT_DEADBAND_MILLISECONDS,
+        "deadband_milliseconds",
+        None,
+    ),
+    ("AlphaTimes100", DEFAULT_ALPHA_TIMES_100, "alpha", lambda v: v / 100),
+    (
+        "AsyncDeltaGpmTimes100",
+        DEFAULT_ASYNC_DELTA_GPM_TIMES_100,
+        "async_delta_gpm",
+        lambda v: v / 100,
+    ),
+    ("NoFlowMilliseconds", DEFAULT_NO_FLOW_MILLISECONDS, "no_flow_milliseconds", None),
+)
+
+# *********************************************
+# CONSTANTS
+# *********************************************
+PULSE_0_PIN = 28
+PULSE_1_PIN = 27
+PULSE_2_PIN = 26
+TIME_WEIGHTING_MS = 800
+HB_TIMER_PERIOD_MS = 3000
+HB_QUIET_S = HB_TIMER_PERIOD_MS // 1000
+# Heartbeat body is patched in place: byte 10 is the hex digit
+HB_BUF_HEX_OFFSET = 10
+HEX_DIGITS = b"0123456789abcdef"
+RING_SIZE = 64  # power of two so the callbacks can mask instead of modulo
+# Ring indices wrap at twice the ring size (empty vs full stays
+# distinguishable) so they remain small ints forever: an unbounded
+# counter would eventually need a big-int increment, which allocates -
+# fatal inside a hard IRQ with the heap locked
+RING_WRAP = 2 * RING_SIZE - 1
+CODE_UPDATE_PERIOD_S = 60
+# Tick deltas coalesce into one POST: HTTP framing dwarfs a 20-byte
+# body, so ship up to 16 deltas per request, flushed on age
+TICK_BATCH_MAX = 16
+TICK_FLUSH_MS = 500
+
+
+def get_hw_uid():
+    return f"pico_{ubinascii.hexlify(machine.unique_id()).decode()[-6:]}"
+
+
+class HttpSession:
+    # One keep-alive socket to base_url shared by every post. Opening a
+    # fresh TCP connection per pulse costs more than the pulse itself on
+    # this radio; holding one open reduces a post to a send plus ack.
+
+    def __init__(self, base_url):
+        rest = base_url.split("://", 1)[-1]
+        hostport = rest.split("/", 1)[0]
+        if ":" in hostport:
+            self._host, port = hostport.split(":", 1)
+            self._port = int(port)
+        else:
+            self._host, self._port = hostport, 80
+        self._host_header = hostport
+        self._sock = None
+
+    def _connect(self):
+        addr = socket.getaddrinfo(self._host, self._port)[0][-1]
+        self._sock = socket.socket()
+        self._sock.connect(addr)
+
+    def _send_request(self, path, body, content_type):
+        # One POST on the session socket; returns (status, content_length,
+        # keep_alive) with the response body left unread on the socket
+        self._sock.send(
+            (
+                "POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: %s\r\n"
+                "Content-Length: %d\r\nConnection: keep-alive\r\n\r\n"
+                % (path, self._host_header, content_type, len(body))
+            ).encode()
+        )
+        self._sock.send(body)
+        status_line = self._sock.readline()
+        status = int(status_line.split(b" ")[1])
+        content_length = 0
+        keep_alive = True
+        while True:
+            line = self._sock.readline()
+            if not line or line == b"\r\n":
+                break
+            lower = line.lower()
+            if lower.startswith(b"content-length:"):
+                content_length = int(line.split(b":", 1)[1])
+            elif lower.startswith(b"connection:") and b"close" in lower:
+                keep_alive = False
+        return status, content_length, keep_alive
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def post(self, path, body, content_type="application/json", read_body=True):
+        # Returns (status, body_bytes); reconnects once if the server
+        # closed the keep-alive socket since the last post. Callers that
+        # only care about the status pass read_body=False and the
+        # response body is drained without being kept.
+        for attempt in (0, 1):
+            if self._sock is None:
+                self._connect()
+            try:
+                status, remaining, keep_alive = self._send_request(
+                    path, body, content_type
+                )
+                chunks = [] if read_body else None
+                while remaining > 0:
+                    chunk = self._sock.read(min(512, remaining))
+                    if not chunk:
+                        break
+                    if read_body:
+                        chunks.append(chunk)
+                    remaining -= len(chunk)
+                if not keep_alive:
+                    self.close()
+                return status, b"".join(chunks) if read_body else b""
+            except OSError:
+                self.close()
+                if attempt == 1:
+                    raise
+
+
+class PicoFlowSlow:
+    def __init__(self):
+        # Pin and timer callbacks cannot allocate, so give MicroPython a
+        # static buffer to report exceptions raised inside them
+        micropython.alloc_emergency_exception_buf(100)
+        self.hw_uid = get_hw_uid()
+        self.load_comms_config()
+        self.load_app_config()
+        self.session = None
+        self.pulse_0_pin = Pin(PULSE_0_PIN, Pin.IN, Pin.PULL_UP)
+        self.pulse_1_pin = Pin(PULSE_1_PIN, Pin.IN, Pin.PULL_UP)
+        self.pulse_2_pin = Pin(PULSE_2_PIN, Pin.IN, Pin.PULL_UP)
+        # Per-pin state lives in position-indexed lists: list indexing
+        # skips the hash probe a dict lookup costs on every pulse
+        self.latest_timestamps_ms = [None, None, None]
+        # Epoch seconds of the last accepted pulse on any pin, for the
+        # heartbeat quiet check. ticks_ms stamps wrap after ~12 days, so
+        # a long-idle pin's stamp would alias as recent; time() seconds
+        # never wrap within a deployment
+        self.latest_pulse_s = None
+        # EMA state in x100 fixed point: soft floats on the FPU-less
+        # RP2040 cost cycles and a heap box per result
+        self._exp_gpm_x100 = [0, 0, 0]
+        self._prev_gpm_x100 = [None, None, None]
+        self.hb = 0
+        # Heartbeat body lives in a prebuilt buffer; posting just patches
+        # one byte instead of formatting a fresh payload
+        self._hb_buf = bytearray(b'{"MyHex":"0","TypeName":"hb","Version":"000"}')
+        self._hb_pending = False
+        self.heartbeat_timer = Timer(-1)
+        # Edge ring shared by the three pin callbacks: each edge is a
+        # timestamp plus its pin number, drained by the main loop so no
+        # HTTP post ever runs in IRQ context
+        self._ring_ms = array("i", bytes(4 * RING_SIZE))
+        self._ring_pin = bytearray(RING_SIZE)
+        self._ri = 0
+        self._wi = 0
+        self._tick_batch = [[], [], []]
+        self._tick_batch_n = 0
+        self._first_queued_ms = None
+        self.last_code_update_s = utime.time()
+
+    # ---------------------------------
+    # Config
+    # ---------------------------------
+    def load_comms_config(self):
+        try:
+            with open(COMMS_CONFIG_FILE, "r") as f:
+                comms_config = ujson.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Error loading comms config file: {e}")
+        self.wifi_name = comms_config.get("WifiName")
+        self.wifi_password = comms_config.get("WifiPassword")
+        self.base_url = comms_config.get("BaseUrl")
+        if self.wifi_name is None:
+            raise KeyError("WifiName not found in comms_config.json")
+        if self.wifi_password is None:
+            raise KeyError("WifiPassword not found in comms_config.json")
+        if self.base_url is None:
+            raise KeyError("BaseUrl not found in comms_config.json")
+
+    def load_app_config(self):
+        try:
+            with open(APP_CONFIG_FILE, "r") as f:
+                app_config = ujson.load(f)
+        except (OSError, ValueError):
+            app_config = {}
+        for key, default, attr, transform in SCALAR_PARAMS:
+            value = app_config.get(key, default)
+            setattr(self, attr, transform(value) if transform else value)
+        self.flow_node_names = list(
+            app_config.get("FlowNodeNames", DEFAULT_FLOW_NODE_NAMES)
+        )
+        gpt_list = app_config.get(
+            "GallonsPerTickTimes10000List",
+            [DEFAULT_GALLONS_PER_TICK_TIMES_10000] * 3,
+        )
+        self.gallons_per_tick = [v / 10_000 for v in gpt_list]
+        self._saved_config_values = None
+        self._rebuild_payload_templates()
+        self._rebuild_urls()
+
+    def _rebuild_urls(self):
+        # Endpoint paths are pure functions of actor_node_name; build
+        # them once instead of f-string interpolating per post
+        prefix = "/" + self.actor_node_name
+        self._gpm_path = prefix + "/gpm"
+        self._tick_batch_path = prefix + "/tick-delta-batch"
+        self._hb_path = prefix + "/hb"
+        self._params_path = prefix + "/flow-slow-params"
+        self._code_path = prefix + "/code-update"
+
+    def _rebuild_payload_templates(self):
+        # Integer views of the float params so the per-pulse math stays
+        # fixed point; rebuilt alongside the templates on config change
+        self._gpt_x10000 = [int(v * 10_000) for v in self.gallons_per_tick]
+        self._alpha_x100 = int(self.alpha * 100)
+        self._async_delta_gpm_x100 = int(self.async_delta_gpm * 100)
+        # The hot payloads are fixed schemas where only one integer
+        # varies; bake the node name in per pin so a post is a single
+        # %-format with no dict and no ujson
+        self._gpm_tmpl = []
+        self._tick_batch_prefix = []
+        for name in self.flow_node_names:
+            name_b = name.encode()
+            self._gpm_tmpl.append(
+                b'{"AboutNodeName":"'
+                + name_b
+                + b'","ValueTimes100":%d,"TypeName":"gpm","Version":"000"}'
+            )
+            self._tick_batch_prefix.append(
+                b'{"AboutNodeName":"' + name_b + b'","MillisecondsList":['
+            )
+
+    def save_app_config(self):
+        # Skip the flash write (slow, and a wear cycle) when the server
+        # echoed back exactly what we already have
+        values = (
+            self.actor_node_name,
+            tuple(self.flow_node_names),
+            tuple(self._gpt_x10000),
+            self.deadband_milliseconds,
+            self._alpha_x100,
+            self._async_delta_gpm_x100,
+            self.no_flow_milliseconds,
+        )
+        if values == self._saved_config_values:
+            return
+        config = {
+            "ActorNodeName": self.actor_node_name,
+            "FlowNodeNames": self.flow_node_names,
+            "GallonsPerTickTimes10000List": [
+                int(v * 10_000) for v in self.gallons_per_tick
+            ],
+            "DeadbandMilliseconds": self.deadband_milliseconds,
+            "AlphaTimes100": int(self.alpha * 100),
+            "AsyncDeltaGpmTimes100": int(self.async_delta_gpm * 100),
+            "NoFlowMilliseconds": self.no_flow_milliseconds,
+        }
+        with open(APP_CONFIG_FILE, "w") as f:
+            ujson.dump(config, f)
+        self._saved_config_values = values
+
+    def update_app_config(self):
+        payload = {
+            "HwUid": self.hw_uid,
+            "ActorNodeName": self.actor_node_name,
+            "FlowNodeNames": self.flow_node_names,
+            "GallonsPerTickTimes10000List": [
+                int(v * 10_000) for v in self.gallons_per_tick
+            ],
+            "DeadbandMilliseconds": self.deadband_milliseconds,
+            "AlphaTimes100": int(self.alpha * 100),
+            "AsyncDeltaGpmTimes100": int(self.async_delta_gpm * 100),
+            "NoFlowMilliseconds": self.no_flow_milliseconds,
+            "TypeName": "flow.slow.params",
+            "Version": "000",
+        }
+        json_payload = ujson.dumps(payload)
+        try:
+            status, body = self.session.post(self._params_path, json_payload)
+            if status == 200 and body:
+                updated_config = ujson.loads(body)
+                old_actor_node_name = self.actor_node_name
+                self.actor_node_name = updated_config.get(
+                    "ActorNodeName", self.actor_node_name
+                )
+                self.flow_node_names = list(
+                    updated_config.get("FlowNodeNames", self.flow_node_names)
+                )
+                gpt_list = updated_config.get(
+                    "GallonsPerTickTimes10000List",
+                    [int(v * 10_000) for v in self.gallons_per_tick],
+                )
+                self.gallons_per_tick = [v / 10_000 for v in gpt_list]
+                self.deadband_milliseconds = updated_config.get(
+                    "DeadbandMilliseconds", self.deadband_milliseconds
+                )
+                self.alpha = (
+                    updated_config.get("AlphaTimes100", int(self.alpha * 100)) / 100
+                )
+                self.async_delta_gpm = (
+                    updated_config.get(
+                        "AsyncDeltaGpmTimes100", int(self.async_delta_gpm * 100)
+                    )
+                    / 100
+                )
+                self.no_flow_milliseconds = updated_config.get(
+                    "NoFlowMilliseconds", self.no_flow_milliseconds
+                )
+                self._rebuild_payload_templates()
+                if self.actor_node_name != old_actor_node_name:
+                    self._rebuild_urls()
+                self.save_app_config()
+        except Exception as e:
+            print(f"Error updating app config: {e}")
+
+    def update_code(self):
+        payload = {
+            "HwUid": self.hw_uid,
+            "ActorNodeName": self.actor_node_name,
+            "TypeName": "new.code",
+            "Version": "000",
+        }
+        json_payload = ujson.dumps(payload)
+        try:
+            status, body = self.session.post(self._code_path, json_payload)
+            if status == 200 and body:
+                # A pending code update comes back as a python file,
+                # otherwise json
+                try:
+                    ujson.loads(body)
+                except ValueError:
+                    with open("main_update.py", "wb") as f:
+                        f.write(body)
+                    machine.reset()
+        except Exception as e:
+            print(f"Error updating code: {e}")
+
+    # ---------------------------------
+    # Wifi
+    # ---------------------------------
+    def connect_to_wifi(self):
+        wlan = network.WLAN(network.STA_IF)
+        wlan.active(True)
+        if not wlan.isconnected():
+            print("Connecting to wifi...")
+            wlan.connect(self.wifi_name, self.wifi_password)
+            while not wlan.isconnected():
+                utime.sleep(1)
+        print(f"Connected to wifi {self.wifi_name}")
+
+    # ---------------------------------
+    # Posting
+    # ---------------------------------
+    def queue_tick_delta(self, pin_number, milliseconds):
+        self._tick_batch[pin_number].append(milliseconds)
+        self._tick_batch_n += 1
+        if self._first_queued_ms is None:
+            self._first_queued_ms = utime.ticks_ms()
+
+    def flush_tick_deltas(self):
+        for pin_number in range(3):
+            deltas = self._tick_batch[pin_number]
+            if not deltas:
+                continue
+            body = (
+                self._tick_batch_prefix[pin_number]
+                + b",".join(b"%d" % v for v in deltas)
+                + b'],"TypeName":"tick.delta.batch","Version":"000"}'
+            )
+            try:
+                self.session.post(self._tick_batch_path, body, read_body=False)
+                deltas.clear()
+            except Exception as e:
+                print(f"Error posting tick deltas: {e}")
+                del deltas[:TICK_BATCH_MAX]
+        self._tick_batch_n = (
+            len(self._tick_batch[0])
+            + len(self._tick_batch[1])
+            + len(self._tick_batch[2])
+        )
+        self._first_queued_ms = utime.ticks_ms() if self._tick_batch_n else None
+
+    def post_gpm(self, pin_number):
+        body = self._gpm_tmpl[pin_number] % self._exp_gpm_x100[pin_number]
+        try:
+            self.session.post(self._gpm_path, body, read_body=False)
+            self._prev_gpm_x100[pin_number] = self._exp_gpm_x100[pin_number]
+        except Exception as e:
+            print(f"Error posting gpm: {e}")
+
+    def post_hb(self):
+        self._hb_buf[HB_BUF_HEX_OFFSET] = HEX_DIGITS[self.hb]
+        try:
+            self.session.post(self._hb_path, self._hb_buf, read_body=False)
+        except Exception as e:
+            print(f"Error posting hb: {e}")
+
+    # ---------------------------------
+    # Heartbeat
+    # ---------------------------------
+    def check_hb(self, timer):
+        # Post a heartbeat when no meter has pulsed recently, so the
+        # server can tell a quiet system from a dead pico
+        last_s = self.latest_pulse_s
+        if last_s is None or utime.time() - last_s > HB_QUIET_S:
+            # Timer callbacks run in ISR context: mark the heartbeat
+            # pending and let the main loop do the posting
+            self.hb = (self.hb + 1) % 16
+            self._hb_pending = True
+
+    def start_heartbeat_timer(self):
+        self.heartbeat_timer.init(
+            period=HB_TIMER_PERIOD_MS,
+            mode=Timer.PERIODIC,
+            callback=self.check_hb,
+        )
+
+    # ---------------------------------
+    # Ticks
+    # ---------------------------------
+    def update_gpm(self, pin_number, delta_ms):
+        if delta_ms > self.no_flow_milliseconds:
+            self._exp_gpm_x100[pin_number] = 0
+            return
+        # gpm = gallons_per_tick * 60 * 1000 / delta_ms, in x100
+        gpm_x100 = (self._gpt_x10000[pin_number] * 600) // delta_ms
+        exp_x100 = self._exp_gpm_x100[pin_number]
+        if exp_x100 == 0:
+            self._exp_gpm_x100[pin_number] = gpm_x100
+            return
+        tw_alpha_x10000 = (delta_ms * self._alpha_x100 * 100) // TIME_WEIGHTING_MS
+        if tw_alpha_x10000 > 10_000:
+            tw_alpha_x10000 = 10_000
+        self._exp_gpm_x100[pin_number] = (
+            tw_alpha_x10000 * gpm_x100 + (10_000 - tw_alpha_x10000) * exp_x100
+        ) // 10_000
+
+    def _handle_pulse(self, pin_number, current_timestamp_ms):
+        self.latest_pulse_s = utime.time()
+        last_ms = self.latest_timestamps_ms[pin_number]
+        if last_ms is None:
+            self.latest_timestamps_ms[pin_number] = current_timestamp_ms
+            return
+        delta_ms = utime.ticks_diff(current_timestamp_ms, last_ms)
+        if delta_ms < self.deadband_milliseconds:
+            return
+        self.latest_timestamps_ms[pin_number] = current_timestamp_ms
+        self.update_gpm(pin_number, delta_ms)
+        prev_x100 = self._prev_gpm_x100[pin_number]
+        if (
+            prev_x100 is None
+            or abs(self._exp_gpm_x100[pin_number] - prev_x100)
+            > self._async_delta_gpm_x100
+        ):
+            self.post_gpm(pin_number)
+        self.queue_tick_delta(pin_number, delta_ms)
+
+    # Pin callbacks only stamp the edge into the ring; ticks_ms returns
+    # a small int so nothing here allocates
+    def pulse_0_callback(self, pin):
+        wi = self._wi
+        i = wi & (RING_SIZE - 1)
+        self._ring_ms[i] = utime.ticks_ms()
+        self._ring_pin[i] = 0
+        self._wi = (wi + 1) & RING_WRAP
+
+    def pulse_1_callback(self, pin):
+        wi = self._wi
+        i = wi & (RING_SIZE - 1)
+        self._ring_ms[i] = utime.ticks_ms()
+        self._ring_pin[i] = 1
+        self._wi = (wi + 1) & RING_WRAP
+
+    def pulse_2_callback(self, pin):
+        wi = self._wi
+        i = wi & (RING_SIZE - 1)
+        self._ring_ms[i] = utime.ticks_ms()
+        self._ring_pin[i] = 2
+        self._wi = (wi + 1) & RING_WRAP
+
+    # ---------------------------------
+    # Main
+    # ---------------------------------
+    def main_loop(self):
+        ring_ms = self._ring_ms
+        ring_pin = self._ring_pin
+        mask = RING_SIZE - 1
+        wrap = RING_WRAP
+        handle_pulse = self._handle_pulse
+        idle = machine.idle
+        while True:
+            ri = self._ri
+            while ri != self._wi:
+                i = ri & mask
+                handle_pulse(ring_pin[i], ring_ms[i])
+                ri = (ri + 1) & wrap
+            self._ri = ri
+            if self._hb_pending:
+                self._hb_pending = False
+                self.post_hb()
+            if self._tick_batch_n and (
+                self._tick_batch_n >= TICK_BATCH_MAX
+                or utime.ticks_diff(utime.ticks_ms(), self._first_queued_ms)
+                > TICK_FLUSH_MS
+            ):
+                self.flush_tick_deltas()
+            now_s = utime.time()
+            if now_s - self.last_code_update_s > CODE_UPDATE_PERIOD_S:
+                self.update_code()
+                self.last_code_update_s = now_s
+            idle()
+
+    def start(self):
+        self.connect_to_wifi()
+        self.session = HttpSession(self.base_url)
+        self.update_app_config()
+        # Let the collector pace itself off the allocation rate instead
+        # of paying a full sweep per post
+        gc.collect()
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+        self.start_heartbeat_timer()
+        # hard=True runs the handlers at interrupt priority; they only
+        # stamp the ring, so edges land even mid-GC or mid-post
+        self.pulse_0_pin.irq(
+            trigger=Pin.IRQ_FALLING, handler=self.pulse_0_callback, hard=True
+        )
+        self.pulse_1_pin.irq(
+            trigger=Pin.IRQ_FALLING, handler=self.pulse_1_callback, hard=True
+        )
+        self.pulse_2_pin.irq(
+            trigger=Pin.IRQ_FALLING, handler=self.pulse_2_callback, hard=True
+        )
+        print("Started tick collection")
+        self.main_loop()
+
+
+if __name__ == "__main__":
+    p = PicoFlowSlow()
+    p.start()
@@ -0,0 +1,46 @@
+"""Runs on a Pi next to the broker: subscribes to pico ticklist
+messages and streams the relative-millisecond timestamps into a CSV
+for scoping a meter. Rows are written as they arrive, so nothing
+accumulates in RAM however long the capture runs."""
+
+import csv
+import json
+import time
+
+import paho.mqtt.client as mqtt
+
+MQTT_BROKER = "localhost"
+MQTT_PORT = 1883
+MQTT_TOPIC = "gw/+/ticklist"
+OUT_FILE = f"scope_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+
+out = open(OUT_FILE, "w", newline="")
+writer = csv.writer(out)
+
+
+def on_connect(client, userdata, flags, rc):
+    print(f"Connected to {MQTT_BROKER} (rc={rc}), writing to {OUT_FILE}")
+    client.subscribe(MQTT_TOPIC)
+
+
+def on_message(client, userdata, msg):
+    try:
+        payload = json.loads(msg.payload)
+    except ValueError:
+        print(f"Ignoring non-json message on {msg.topic}")
+        return
+    writer.writerow(["new_batch"])
+    for ts in payload.get("RelativeMillisecondList", []):
+        writer.writerow([ts])
+    out.flush()
+
+
+if __name__ == "__main__":
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(MQTT_BROKER, MQTT_PORT)
+    try:
+        client.loop_forever()
+    finally:
+        out.close()